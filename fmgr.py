@@ -1,37 +1,72 @@
 import os
+import asyncio
 import glob
 import collections
+import concurrent.futures
 import shutil
+import stat
+import sys
 from pathlib import Path
 import hashlib
-import zipfile
+import mmap
+import random
+import zlib
+from dataclasses import dataclass
 from datetime import datetime as dt
 from optparse import OptionParser
 import traceback
+import numpy as np
 from tqdm import tqdm
-import PIL
-from PIL import Image
-import pdb
+import cv2
+try:
+    import blake3
+except ImportError:
+    blake3 = None  # optional, falls back to sha1
+try:
+    from numba import njit
+except ImportError:
+    njit = None  # optional, falls back to numpy
 
 KB = 2**10
 MB = 2**20
 GB = 2**30
 
-UNITS_DISPLAY = [(2**10, "B"), (2**20, "KB"), (2**30, "MB")]
+UNITS_DISPLAY = ((1, "B"), (KB, "KB"), (MB, "MB"), (GB, "GB"))
 def fmtnum(size):
-    for limit, unit in UNITS_DISPLAY:
-        if size < limit:
-            return str(round(size / (limit / 1024), 2)) + unit
-    return str(round(size / 2**30, 2)) + "GB"
+    # bit_length() picks the unit in one integer op, no loop or branches
+    i = min((max(size, 1).bit_length() - 1) // 10, 3)
+    div, unit = UNITS_DISPLAY[i]
+    return f"{size / div:.2f}{unit}"
 
 
+if njit is not None:
+    # no parallel=True: numba's default threading layer is not fork-safe
+    # and would hang the process pools used by the reports
+    @njit(cache=True)
+    def _pct(sizes, ext_sum, total):
+        """ LLVM-vectorized percent kernel """
+        n = sizes.size
+        percent = np.empty(n)
+        percent_all = np.empty(n)
+        for i in range(n):
+            percent[i] = sizes[i] * 100.0 / ext_sum
+            percent_all[i] = sizes[i] * 100.0 / total
+        return percent, percent_all
+else:
+    def _pct(sizes, ext_sum, total):
+        return sizes * (100.0 / ext_sum), sizes * (100.0 / total)
+
+
+@dataclass(slots=True)
 class FileInfo:
     """
-    For holding file information
+    For holding file information; only materialized for printed rows, the
+    bulk per-file data lives in the index arrays
     """
-    def __init__(self, path, size):
-        self.path = path
-        self.size = size
+    path: str
+    size: int
+    percent: float = 0.0
+    percent_all: float = 0.0
 
     def __str__(self):
         return "File: {}, size: {}, percent of same extension: {}%, percent of all extensions {}%"\
@@ -42,6 +77,7 @@ class ExtInfo:
     """
     For holding information for all files with a specific extension
     """
+    __slots__ = ('ex', 'nfiles', 'size', 'comp_size', 'diff', 'diff_percent')
     def __init__(self, ex, nfiles, size, comp_size):
         self.ex = ex
         self.nfiles = nfiles
@@ -71,17 +107,30 @@ class FileMgmt:
         l = glob.glob(fullpath)
         return l
 
+    @staticmethod
+    def _scan(dir_path):
+        """ yield os.DirEntry objects recursively; the entries carry the
+        stat info from the directory read so callers avoid extra stat() """
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from FileMgmt._scan(entry.path)
+                    else:
+                        yield entry
+        except PermissionError:
+            pass # ignoring directories with no permission
+
     @staticmethod
     def list_files_recursive(dir_path):
-        dir_path = Path(dir_path)
-        return dir_path.glob('**/*')
+        return FileMgmt._scan(dir_path)
 
     def show_ext_count(self, dir_path):
         iter_files = self.list_files(dir_path)
         extdict = collections.defaultdict(int)
         for fullpath in iter_files:
-            _, file_extension = os.path.splitext(fullpath)
-            extdict[file_extension[1:]] += 1
+            name = os.path.basename(fullpath)
+            extdict[name.rpartition('.')[2] if '.' in name[1:] else ''] += 1
         for filext, cnt in extdict.items():
             print(cnt, filext)
 
@@ -89,118 +138,246 @@ class FileMgmt:
         iter_files = self.list_files(dir_path)
         d = {}
         for filename in iter_files:
-            fname, _ = os.path.splitext(filename)
             fs = os.stat(filename)
             modtime = dt.fromtimestamp(fs.st_mtime)
             d[filename] = str(modtime)
         return d
 
+    @staticmethod
+    def _copyfile(src, dst):
+        """ in-kernel copy where supported: bytes never touch user space,
+        and CoW filesystems (btrfs/xfs) turn it into a reflink """
+        if not hasattr(os, 'copy_file_range'):
+            shutil.copyfile(src, dst)
+            return
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                remaining = os.fstat(src_fd).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            finally:
+                os.close(dst_fd)
+        except OSError:
+            shutil.copyfile(src, dst) # e.g. crossing filesystems
+        finally:
+            os.close(src_fd)
+
     DATE_PART_IX = 7
     def organizefiles(self, source, dest):
         d = self.filestat(source)
+        lines = []
         for filepath, fdate in d.items():
             foldername = fdate[:self.DATE_PART_IX].replace("-", "_")
             destpath = os.path.join(dest, foldername)
             destfile = os.path.join(destpath, os.path.basename(filepath))
-            if not os.path.exists(destpath):
-                os.mkdir(destpath)
-            print("copying {} --> {}".format(filepath, destfile))
-            shutil.copyfile(filepath, destfile)
+            os.makedirs(destpath, exist_ok=True)
+            lines.append("copying {} --> {}\n".format(filepath, destfile))
+            self._copyfile(filepath, destfile)
+        sys.stdout.write("".join(lines))
+
+    def _index(self, dir_path):
+        """ one traversal produces path/size/ext columns shared by all the
+        reports, so multiple reports on the same tree scan it only once """
+        if dir_path in self.extdicts:
+            return self.extdicts[dir_path]
+        paths = []
+        sizes = []
+        exts = []
+        for entry in self._scan(dir_path):
+            try:
+                # one stat per entry answers both the type check and the
+                # size; DirEntry serves it from the directory read
+                st = entry.stat()
+            except OSError:
+                continue # ignoring files with no permission or broken links
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            name = entry.name
+            paths.append(entry.path)
+            sizes.append(st.st_size)
+            # rpartition beats splitext when only the extension is
+            # needed; the [1:] guard keeps dotfiles extension-less
+            exts.append(name.rpartition('.')[2] if '.' in name[1:] else '')
+        index = {'paths': np.array(paths, dtype=object),
+                 'sizes': np.array(sizes, dtype=np.int64),
+                 'exts': np.array(exts, dtype=object)}
+        self.extdicts[dir_path] = index
+        return index
 
     def show_treesize(self, dir_path):
-        folder_sum = 0
-        f_list = []
-        iter_files = self.list_files_recursive(dir_path)
-        for filename in iter_files:
-            if filename.is_file():
-                fsize = filename.stat().st_size
-                f_obj = FileInfo(filename, fsize)
-                folder_sum += fsize
-                f_list.append((filename, f_obj))
-        f_list.sort(key=lambda tup:tup[1].size, reverse=True)
-        for fullpath, f_obj in f_list:
-            print(fullpath, fmtnum(f_obj.size), str(round((f_obj.size / folder_sum) * 100, 2)) + "%")
-
-    BLOCKSIZE = 64*KB
-    def generate_hash(self, file_path):
-        file_hash = hashlib.sha1()
+        index = self._index(dir_path)
+        sizes = index['sizes']
+        folder_sum = sizes.sum()
+        for i in np.argsort(-sizes):
+            fsize = int(sizes[i])
+            print(index['paths'][i], fmtnum(fsize), str(round((fsize / folder_sum) * 100, 2)) + "%")
+
+    BLOCKSIZE = MB
+    @staticmethod
+    def generate_hash(file_path):
+        # duplicate detection doesn't need cryptographic sha1; blake3 is
+        # SIMD-parallel and hashes large files with multiple threads
+        if blake3 is not None:
+            file_hash = blake3.blake3()
+            if os.path.getsize(file_path) > MB:
+                file_hash.update_mmap(file_path)
+            else:
+                with open(file_path, 'rb') as f:
+                    file_hash.update(f.read())
+            return file_hash.hexdigest()
         with open(file_path, 'rb') as f:
-            buf = f.read(self.BLOCKSIZE)
-            while len(buf) > 0:
-                file_hash.update(buf)
-                buf = f.read(self.BLOCKSIZE)
+            if hasattr(hashlib, 'file_digest'):
+                # Python 3.11+: the whole read/update loop runs in C
+                return hashlib.file_digest(f, 'sha1').hexdigest()
+            file_hash = hashlib.sha1()
+            size = os.fstat(f.fileno()).st_size
+            if size < FileMgmt.BLOCKSIZE:
+                file_hash.update(f.read())
+            else:
+                # one mmap, one update: no read syscalls or buffer copies,
+                # the kernel streams pages in as the hash consumes them
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, 'madvise'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    file_hash.update(mm)
         return file_hash.hexdigest()
 
-    def find_duplicates(self, dir_path):
+    FINGERPRINT_SIZE = 4*KB
+    @staticmethod
+    def _head_tail_hash(file_path, size):
+        """ cheap fingerprint over the first and last 4 KiB; rejects almost
+        all same-size non-duplicates for 8 KiB of I/O per file """
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            head = os.pread(fd, FileMgmt.FINGERPRINT_SIZE, 0)
+            tail = os.pread(fd, FileMgmt.FINGERPRINT_SIZE,
+                            max(size - FileMgmt.FINGERPRINT_SIZE, 0))
+        finally:
+            os.close(fd)
+        file_hash = blake3.blake3() if blake3 is not None else hashlib.sha1()
+        file_hash.update(head)
+        file_hash.update(tail)
+        return file_hash.hexdigest()
+
+    HASH_QUEUE_DEPTH = 32
+    def _hash_paths_threaded(self, paths):
+        """ hash with many reads in flight instead of many cores: a deeper
+        I/O queue lets the disk scheduler reorder seeks on HDD/NFS """
+        async def run():
+            sem = asyncio.Semaphore(self.HASH_QUEUE_DEPTH)
+            async def one(path):
+                async with sem:
+                    return path, await asyncio.to_thread(self.generate_hash, path)
+            return await asyncio.gather(*[one(path) for path in paths])
+        return asyncio.run(run())
+
+    def find_duplicates(self, dir_path, io_bound=False):
+        """ io_bound=True overlaps reads with threads instead of spreading
+        hashing over cores; use it on rotational disks or network shares """
+        # files with a unique size cannot be duplicates, so group by size
+        # first and only hash the collision groups
+        index = self._index(dir_path)
+        dict_size = collections.defaultdict(list)
+        for path, size in zip(index['paths'], index['sizes']):
+            dict_size[int(size)].append(path)
+        # second stage: files sharing a size rarely share head+tail bytes
+        # too, so only fingerprint collisions pay for a full hash
+        dict_fp = collections.defaultdict(list)
+        for size, same_size in dict_size.items():
+            if len(same_size) > 1:
+                for path in same_size:
+                    dict_fp[(size, self._head_tail_hash(path, size))].append(path)
+        candidates = [f for same_fp in dict_fp.values() if len(same_fp) > 1
+                      for f in same_fp]
         dict_hash = collections.defaultdict(list)
-        file_list = self.list_files_recursive(dir_path)
-        for fullpath in file_list:
-            if fullpath.is_file():
-                f_hash = self.generate_hash(fullpath)
-                dict_hash[f_hash].append(fullpath)
+        if io_bound:
+            hashed = self._hash_paths_threaded(candidates)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+                hashed = zip(candidates,
+                             executor.map(self.generate_hash, candidates, chunksize=16))
+        for fullpath, f_hash in hashed:
+            dict_hash[f_hash].append(fullpath)
         for _, dup_files in dict_hash.items():
             if len(dup_files) > 1:
                 print("Duplicated files: {}".format(dup_files))
 
     def get_ext_map(self, dir_path):
-        if dir_path in self.extdicts:
-            return self.extdicts[dir_path]
-        iter_files = self.list_files_recursive(dir_path)
-        ext_dict = collections.defaultdict(list)
-        for file_path in iter_files:
-            try:
-                if file_path.is_file():
-                    _, file_ext = os.path.splitext(file_path)
-                    curr_size = file_path.stat().st_size
-                    fi = FileInfo(file_path, curr_size)
-                    ext_dict[file_ext[1:]].append(fi)
-            except PermissionError:
-                pass # ignoring files with no permission
-        self.extdicts[dir_path] = ext_dict
-        return self.extdicts[dir_path]
+        """ return {extension: (paths array, sizes array)} columns; parallel
+        arrays keep the per-file overhead out of the stats arithmetic """
+        index = self._index(dir_path)
+        ext_map = {}
+        for ext in np.unique(index['exts']):
+            mask = index['exts'] == ext
+            ext_map[ext] = (index['paths'][mask], index['sizes'][mask])
+        return ext_map
 
     def extension_stats(self, dir_path, n=5, should_print=False):
-        ext_dict = self.get_ext_map(dir_path)
-        ext_sum_all = 0
-        for _, values, in ext_dict.items():
-            ext_sum = sum([f.size for f in values])
-            ext_sum_all += ext_sum
-            for f in values:
-                f.percent = round((f.size / ext_sum) * 100, 2)
-        for _, values, in ext_dict.items():
-            for f in values:
-                f.percent_all = round((f.size / ext_sum_all) * 100, 2)
-        for _, v in ext_dict.items():
-            v.sort(key=lambda curr_f:curr_f.size, reverse=True)
+        ext_map = self.get_ext_map(dir_path)
+        ext_sum_all = sum([int(sizes.sum()) for _, sizes in ext_map.values()])
         if should_print:
-            for e, v in ext_dict.items():
-                print("Top {} files in extension {}:".format(len(v[:n]), e))
-                for value in v[:n]:
-                    print(value)
-
-    def compress_file(self, f):
-        sample_filepath = 'sample.zip'
-        with zipfile.ZipFile(sample_filepath, 'w') as zf:
-            zf.write(f, compress_type=zipfile.ZIP_DEFLATED)
-        if os.path.exists(sample_filepath):
-            os.remove(sample_filepath)
-        return zf
+            for ext, (paths, sizes) in ext_map.items():
+                percent, percent_all = _pct(sizes, sizes.sum(), ext_sum_all)
+                top = np.argsort(-sizes)[:n]
+                print("Top {} files in extension {}:".format(len(top), ext))
+                # only the printed rows get materialized as objects
+                for i in top:
+                    f = FileInfo(paths[i], int(sizes[i]))
+                    f.percent = round(float(percent[i]), 2)
+                    f.percent_all = round(float(percent_all[i]), 2)
+                    print(f)
 
+    @staticmethod
+    def compress_file(file_path):
+        """ deflate the file in memory and return (size, compressed size);
+        level 1 is much faster than the zip default with a similar ratio """
+        co = zlib.compressobj(zlib.Z_BEST_SPEED, zlib.DEFLATED, -15)
+        total_in = 0
+        total_out = 0
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(FileMgmt.BLOCKSIZE), b''):
+                total_in += len(chunk)
+                total_out += len(co.compress(chunk))
+        total_out += len(co.flush())
+        return total_in, total_out
+
+    SAMPLE_MAX_FILES = 32
+    # already-compressed formats can't shrink, don't waste deflate on them
+    INCOMPRESSIBLE = {'jpg', 'jpeg', 'png', 'mp4', 'mov', 'mp3', 'zip', '7z',
+                      'gz', 'xz', 'zst', 'webp', 'heic'}
     def compress_report(self):
         print("================== COMPRESS REPORT ==================")
-        ext_dict = self.get_ext_map(self.path)
+        ext_map = self.get_ext_map(self.path)
         print("Calculating compression ratio...")
+        # the ratio is a population statistic, so compressing a random
+        # sample per extension and extrapolating is accurate enough
+        totals = {ext: [0, 0] for ext in ext_map}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {}
+            for ext, (paths, _) in ext_map.items():
+                if ext.lower() in self.INCOMPRESSIBLE:
+                    continue
+                sample = paths if len(paths) <= self.SAMPLE_MAX_FILES \
+                    else random.sample(list(paths), self.SAMPLE_MAX_FILES)
+                for path in sample:
+                    futures[executor.submit(self.compress_file, path)] = ext
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                ext = futures[future]
+                size, comp_size = future.result()
+                totals[ext][0] += size
+                totals[ext][1] += comp_size
         ext_info_list = []
-        for ext, files_list in tqdm(ext_dict.items()):
-            total_size = 0
-            total_size_comp = 0
-            for f in files_list:
-                zf = self.compress_file(f.path)
-                comp_file = zf.namelist()[0]
-                total_size += zf.getinfo(comp_file).file_size
-                total_size_comp += zf.getinfo(comp_file).compress_size
-            ei = ExtInfo(ext, len(files_list), total_size, total_size_comp)
-            ext_info_list.append(ei)
+        for ext, (sampled_size, sampled_comp) in totals.items():
+            # scale the sampled ratio up to the real extension size
+            paths, sizes = ext_map[ext]
+            ext_size = int(sizes.sum())
+            est_comp = round(ext_size * sampled_comp / sampled_size) if sampled_size else ext_size
+            ext_info_list.append(ExtInfo(ext, len(paths), ext_size, est_comp))
 
         for ei in ext_info_list:
             if ei.diff > (100*MB):
@@ -209,34 +386,48 @@ class FileMgmt:
                               fmtnum(ei.diff), round(ei.diff_percent, 2)))
         print("=====================================================")
 
+    JPG_ENCODE_FLAGS = [int(cv2.IMWRITE_JPEG_QUALITY), 0, int(cv2.IMWRITE_JPEG_OPTIMIZE), 1]
+    @staticmethod
+    def _encode_one(task):
+        """ worker: decode + re-encode one jpg in memory, the buffer length
+        is the re-encoded size so no temp file gets written and stat'ed """
+        dirname, jpg_path, size, encode_flags = task
+        img = cv2.imread(jpg_path)
+        ok = img is not None
+        if ok:
+            ok, buf = cv2.imencode('.jpg', img, encode_flags)
+        return dirname, size, len(buf) if ok else 0, ok
+
     def jpg_quality_reduce_report(self, quality):
         print("==================== JPG REPORT ====================")
-        sample_file = os.path.join(self.path, "sample.jpg")
+        encode_flags = list(self.JPG_ENCODE_FLAGS)
+        encode_flags[1] = quality
+        jpg_extensions = ["jpg", "jpeg", "JPG"]
+        tasks = []
         for dir_path in Path(self.path).iterdir():
             if not dir_path.is_dir():
                 continue
             em = self.get_ext_map(dir_path)
-            total_before = total_after = 0
-            jpg_extensions = ["jpg", "jpeg", "JPG"]
-            num_files = sum([len(em[x]) for x in jpg_extensions])
             for ex_type in jpg_extensions:
-                for jpg_fi in em[ex_type]:
-                    try:
-                        foo = Image.open(jpg_fi.path)
-                        foo.save(sample_file, optimize=True, quality=quality)
-                        w = Path(sample_file)
-                        total_before += jpg_fi.size
-                        total_after += w.stat().st_size
-                    except PIL.UnidentifiedImageError:
-                        num_files-=1
-                        pass
-            if num_files:
-                dr_ratio = round(100*(total_before-total_after)/total_before)
-                print("Directory {}: {} jpg files, size {} -> {} ({}%), quality {}".format(
-                    dir_path, num_files,
-                    fmtnum(total_before), fmtnum(total_after),dr_ratio, quality))
-        if os.path.exists(sample_file):
-            os.remove(sample_file)
+                jpg_paths, jpg_sizes = em.get(ex_type, ((), ()))
+                for jpg_path, jpg_size in zip(jpg_paths, jpg_sizes):
+                    tasks.append((str(dir_path), jpg_path, int(jpg_size), encode_flags))
+        # decode + encode dominates and is per-file independent, so fan the
+        # files out to all cores and reduce per directory here
+        totals = collections.defaultdict(lambda: [0, 0, 0])
+        with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for dirname, size_before, size_after, ok in executor.map(self._encode_one, tasks,
+                                                                     chunksize=16):
+                if ok:
+                    dir_totals = totals[dirname]
+                    dir_totals[0] += 1
+                    dir_totals[1] += size_before
+                    dir_totals[2] += size_after
+        for dirname, (num_files, total_before, total_after) in totals.items():
+            dr_ratio = round(100*(total_before-total_after)/total_before)
+            print("Directory {}: {} jpg files, size {} -> {} ({}%), quality {}".format(
+                dirname, num_files,
+                fmtnum(total_before), fmtnum(total_after),dr_ratio, quality))
         print("=====================================================")
 
 
@@ -262,7 +453,6 @@ if __name__ == "__main__":
     try:
         print(options)
         fm = FileMgmt(options.rootpath)
-        ##pdb.set_trace()
         if options.zip:
             fm.compress_report()
         if options.jpg_quality: